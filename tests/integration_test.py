@@ -1,84 +1,159 @@
 import sqlite3
 import os, sys
+import gc
 import random
 import string
 import subprocess
 import time
 import shutil
+import signal
+import threading
+
+# rows generated and inserted per insert_random_data() call
+_BATCH_ROWS = 1000
+# rows written between two commits of the insert transaction
+_COMMIT_INTERVAL = 5000
+# sqlite page size and page cache size of the test db
+_PAGE_SIZE = 8192
+_CACHE_SIZE_KIB = 128 * 1024
+# rows fetched per round trip when reading query results
+_FETCH_ROWS = 10000
+# the replicator checks the db once per second
+_REPLICATE_INTERVAL = 1
+
+# rows per multi-row INSERT statement, largest first. 400 rows keep the
+# statement below sqlite's default limit of 999 bound parameters.
+_BATCH_SIZES = (400, 16, 4, 1)
+# sql texts are built once so sqlite3's statement cache always hits. Inserted
+# rows are returned so the expected data needs no extra query (sqlite 3.35+).
+_INSERT_SQL = "INSERT INTO random_data (name, value) VALUES (?, ?)"
+_INSERT_SQLS = {
+    k: _INSERT_SQL + ",(?, ?)" * (k - 1) + " RETURNING id, name, value"
+    for k in _BATCH_SIZES
+}
+
+# maps every byte to an ascii letter, used to turn random bytes into names
+_NAME_LEN = 5
+_NAME_TABLE = (string.ascii_letters * 5).encode("ascii")[:256]
+# fixed seed so that every run inserts the same names
+_NAME_SEED = 0
 
 class Test:
-    def __init__(self, root, max_records):
-        self.conn = sqlite3.connect(root + '/test.db')
-        self.max_records = max_records
+    def __init__(self, root, max_records, replica_dir):
+        self.conn = sqlite3.connect(root + '/test.db', cached_statements=256)
         self.cursor = self.conn.cursor()
+        # page_size only applies to a new db and cannot change once it is in WAL mode
+        self.cursor.execute("PRAGMA page_size=" + str(_PAGE_SIZE))
+        mode = self.cursor.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        assert mode == "wal", "set journal_mode=wal failed: " + mode
+        page_size = self.cursor.execute("PRAGMA page_size").fetchone()[0]
+        assert page_size == _PAGE_SIZE, "set page_size failed: " + str(page_size)
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.cursor.execute("PRAGMA cache_size=-" + str(_CACHE_SIZE_KIB))
+        # manage transactions explicitly, see insert()
+        self.conn.isolation_level = None
+        self.max_records = max_records
+        self.replica_dir = replica_dir
         
     def create_table(self):
-        self.conn.execute('''
+        self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS random_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             name TEXT NOT NULL,
             value INTEGER NOT NULL
         )
         ''') 
 
     def insert_random_data(self, start):
-        num_records = random.randint(1, 20)
-        records = []
-        for i in range(num_records):
-            name = ''.join(random.choices(string.ascii_letters, k=5))
-            value = i + start
-            records.append((name, value))
-        self.cursor.executemany('INSERT INTO random_data (name, value) VALUES (?, ?)', records)
-        self.conn.commit()
+        num_records = min(_BATCH_ROWS, self.max_records - start)
+        blob = self.names[start * _NAME_LEN:(start + num_records) * _NAME_LEN]
+        # flat (name, value, name, value, ...) parameters for the multi-row inserts
+        params = [None] * (2 * num_records)
+        params[0::2] = [blob[i:i + _NAME_LEN] for i in range(0, len(blob), _NAME_LEN)]
+        params[1::2] = range(start, start + num_records)
+        i = 0
+        while i < num_records:
+            k = next(k for k in _BATCH_SIZES if k <= num_records - i)
+            self.cursor.execute(_INSERT_SQLS[k], params[2 * i:2 * (i + k)])
+            self.rows.extend(self.cursor.fetchall())
+            i += k
 
         return num_records
 
     def insert(self):
         num_records = 0
-        sleep_num = 0
+        commit_num = 0
+        # generate the names of all rows up front, insert_random_data() slices them
+        rng = random.Random(_NAME_SEED)
+        self.names = rng.randbytes(_NAME_LEN * self.max_records).translate(_NAME_TABLE).decode('ascii')
+        # (id, name, value) of every inserted row, see query_data()
+        self.rows = []
+        self.cursor.execute("BEGIN")
         while num_records < self.max_records:
             num = self.insert_random_data(num_records)
             num_records += num
-            sleep_num += num
-            if sleep_num > 500:
-                print("after insert ", sleep_num, " data, total: ", num_records, ", go to sleep(1)")
-                time.sleep(1)
-                sleep_num = 0
+            commit_num += num
+            if commit_num >= _COMMIT_INTERVAL:
+                # commit before waiting so that the replicator can pick up the wal
+                self.cursor.execute("COMMIT")
+                print("after insert ", commit_num, " data, total: ", num_records, ", wait for replicate")
+                wait_replicated(self.replica_dir, time.time())
+                commit_num = 0
+                self.cursor.execute("BEGIN")
+        self.cursor.execute("COMMIT")
 
         print("finish insert test data, total: ", num_records)
 
     def query_data(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM random_data order by value')
-        return cursor.fetchall()
+        # RETURNING gives no row order guarantee, sort like 'order by value'
+        return sorted(self.rows, key=lambda r: r[2])
+
+# rename `path` out of the way and remove it in a background thread, so a
+# large tree left by the previous run does not delay the test start
+def clean_dir(path):
+    old = path + ".old." + str(time.time_ns())
+    try:
+        os.rename(path, old)
+    except FileNotFoundError:
+        return
+    threading.Thread(target=shutil.rmtree, args=(old,), kwargs={"ignore_errors": True}).start()
 
 class ConfigGenerator:
-    def __init__(self):
+    # template file contents, keyed by template path
+    _templates = {}
+
+    def __init__(self, tmpfs):
         self.cwd = os.getcwd()
         self.root = self.cwd + "/.test"
-        # clean test dir
-        try:
-            shutil.rmtree(self.root)
-            pass
-        except:
-            pass
+        # clean test dir, a symlink is left by a previous tmpfs run
+        if os.path.islink(self.root):
+            clean_dir(os.readlink(self.root))
+            os.unlink(self.root)
+        else:
+            clean_dir(self.root)
         print("root: ", self.root)
-        try:
-            os.makedirs(self.root)
-        except:
-            pass
+        if tmpfs:
+            # keep the test dir in memory, the replicator follows the symlink
+            shm = "/dev/shm/replited-test-" + str(os.getuid())
+            clean_dir(shm)
+            os.makedirs(shm)
+            os.symlink(shm, self.root)
+            print("root is linked to ", shm)
+        else:
+            try:
+                os.makedirs(self.root)
+            except:
+                pass
 
         self.config_file = self.root + "/replited.toml"
+        # directory touched by the replicator, polled by wait_replicated()
+        self.replica_dir = self.root + "/.test.db-replited"
 
     def generate(self):
         print("generate config for backend type ", self.type)
         self.do_generate()
 
-class FsConfigGenerator(ConfigGenerator):
-    def __init__(self):
-        ConfigGenerator.__init__(self)
-        self.type = 'Fs'
-
     def do_generate(self):
         # create root dir of fs
         try:
@@ -87,70 +162,65 @@ class FsConfigGenerator(ConfigGenerator):
             pass
 
         # generate config file
-        file = open(self.cwd + '/tests/config/fs_template.toml')
-        content = file.read()
-        content = content.replace('{root}', self.root)
-        config_file = self.config_file
-        file = open(config_file, 'w+')
-        file.write(content)
-        file.close()
+        path = self.cwd + '/tests/config/' + self.template
+        if path not in ConfigGenerator._templates:
+            with open(path) as f:
+                ConfigGenerator._templates[path] = f.read()
+        content = ConfigGenerator._templates[path].format_map({'root': self.root})
+        with open(self.config_file, 'w') as f:
+            f.write(content)
+
+class FsConfigGenerator(ConfigGenerator):
+    def __init__(self, tmpfs):
+        ConfigGenerator.__init__(self, tmpfs)
+        self.type = 'Fs'
+        self.template = 'fs_template.toml'
+        self.replica_dir = self.root + "/replited"
 
 class S3ConfigGenerator(ConfigGenerator):
-    def __init__(self):
-        ConfigGenerator.__init__(self)
+    def __init__(self, tmpfs):
+        ConfigGenerator.__init__(self, tmpfs)
         self.type = 'S3'
-
-    def do_generate(self):
-        # create root dir of fs
-        try:
-            os.makedirs(self.root + "/replited")
-        except:
-            pass
-
-        # generate config file
-        file = open(self.cwd + '/tests/config/s3_template.toml')
-        content = file.read()
-        content = content.replace('{root}', self.root)
-        config_file = self.config_file
-        file = open(config_file, 'w+')
-        file.write(content)
-        file.close()
+        self.template = 's3_template.toml'
 
 class FtpConfigGenerator(ConfigGenerator):
-    def __init__(self):
-        ConfigGenerator.__init__(self)
+    def __init__(self, tmpfs):
+        ConfigGenerator.__init__(self, tmpfs)
         self.type = 'Ftp'
-
-    def do_generate(self):
-        # create root dir of fs
-        try:
-            os.makedirs(self.root + "/replited")
-        except:
-            pass
-
-        # generate config file
-        file = open(self.cwd + '/tests/config/ftp_template.toml')
-        content = file.read()
-        content = content.replace('{root}', self.root)
-        config_file = self.config_file
-        file = open(config_file, 'w+')
-        file.write(content)
-        file.close()
+        self.template = 'ftp_template.toml'
+
+def latest_mtime(path):
+    mtime = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                mtime = max(mtime, os.path.getmtime(os.path.join(dirpath, name)))
+            except FileNotFoundError:
+                pass
+    return mtime
+
+# wait until the replicator writes into `path` after `since`, and with `settle`
+# until it has not written anything for `settle` seconds
+def wait_replicated(path, since, settle=0, timeout=10):
+    deadline = time.time() + timeout
+    last = 0
+    last_change = time.time()
+    while time.time() < deadline:
+        mtime = latest_mtime(path)
+        if mtime != last:
+            last = mtime
+            last_change = time.time()
+        if last > since and time.time() - last_change >= settle:
+            return
+        time.sleep(0.05)
+    print("wait for replicate in ", path, " timeout after ", timeout, "s")
 
 def start_replicate(p, config_file):
-    cmd = p + " --config " + config_file + " replicate &"
-    print("replicate cmd: ", cmd)
-    #cmds = [p, "--config", config_file, "replicate", "&"]
-    #pipe = subprocess.Popen(cmds, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #ret = os.popen(cmds)
-    os.system(cmd)
-    #print("after replicate")
-    #print("after replicate: ", pipe.stdout.read())
-
-def stop_replicate():
-    cmd = "killall replited"
-    os.system(cmd)
-    #subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cmds = [p, "--config", config_file, "replicate"]
+    print("replicate cmd: ", cmds)
+    # own process group, so stopping it never touches other replited instances
+    return subprocess.Popen(cmds, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
 
 def test_restore(p, config_file, root, exp_data):
     db = root + "/test.db"
@@ -159,33 +229,36 @@ def test_restore(p, config_file, root, exp_data):
         os.remove(output)
     except:
         pass
-    cmd = p + " --config " + config_file + " restore --db " + db + " --output " + output
-    #cmds = [p, "--config", config_file,"restore", "--db", db, "--output", output]
-    print("restore: ", cmd)
-    #pipe = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #pipe = subprocess.Popen(cmds, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    os.system(cmd)
-    #print("after restore")
+    cmds = [p, "--config", config_file, "restore", "--db", db, "--output", output]
+    print("restore: ", cmds)
+    ret = subprocess.run(cmds, check=True, capture_output=True)
+    print(ret.stdout.decode())
 
     conn = sqlite3.connect(output)
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM random_data order by value')
-    data = cursor.fetchall()
-    print("data len: ", len(data), ", exp_data len: ", len(exp_data))
-    assert data == exp_data
-
-def decide_config_generator(config_type):
+    # compare chunk by chunk instead of materializing the whole restored table
+    num = 0
+    while chunk := cursor.fetchmany(_FETCH_ROWS):
+        assert chunk == exp_data[num:num + len(chunk)], "restored data mismatch after row " + str(num)
+        num += len(chunk)
+    conn.close()
+    print("data len: ", num, ", exp_data len: ", len(exp_data))
+    assert num == len(exp_data)
+
+def decide_config_generator(config_type, tmpfs):
     if config_type == "fs":
-        return FsConfigGenerator()
+        return FsConfigGenerator(tmpfs)
     elif config_type == "s3":
-        return S3ConfigGenerator()
+        return S3ConfigGenerator(tmpfs)
     elif config_type == "ftp":
-        return FtpConfigGenerator()
+        return FtpConfigGenerator(tmpfs)
     else:
         print("invalid config type: ", config_type)
         sys.exit(-1)
 
-# python3 tests/integration_test.py [number of data] [config type] [replited bin path]
+# python3 tests/integration_test.py [number of data] [config type] [replited bin path] [--tmpfs]
+# --tmpfs: put the test dir under /dev/shm
 if __name__ == '__main__':
     print("args: ", sys.argv)
     number = int(sys.argv[1])
@@ -194,23 +267,34 @@ if __name__ == '__main__':
         sys.exit(-1)
     config_type = sys.argv[2]
     bin_path = sys.argv[3]
+    tmpfs = "--tmpfs" in sys.argv[4:]
 
-    stop_replicate()
-
-    config = decide_config_generator(config_type)
+    config = decide_config_generator(config_type, tmpfs)
     config.generate()
 
-    test = Test(config.root, number)
+    test = Test(config.root, number, config.replica_dir)
     test.create_table()
 
-    start_replicate(bin_path, config.config_file)
+    proc = start_replicate(bin_path, config.config_file)
 
-    test.insert()
+    # the insert loop creates no reference cycles, skip cyclic gc while it runs
+    gc.disable()
+    try:
+        test.insert()
+    finally:
+        gc.enable()
+        gc.collect()
 
-    time.sleep(3)
+    # wait until the replicator has been idle for longer than its sync interval
+    wait_replicated(config.replica_dir, time.time(), settle=_REPLICATE_INTERVAL * 1.5)
     data = test.query_data()
 
-    stop_replicate()
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
 
     test_restore(bin_path, config.config_file, config.root, data)
 